@@ -0,0 +1,77 @@
+# cache.py
+"""
+Persistent semantic cache for Gemini responses (sqlite + embeddings).
+Rows are grouped by an exact-match scope (model, template, instruction and
+context values); within a scope, a text whose embedding is close enough
+(cosine similarity) to a stored one reuses the stored response, across
+process restarts.
+"""
+import hashlib
+import sqlite3
+import time
+from contextlib import closing
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+class SemanticCache:
+    def __init__(self, path: str, threshold: float=0.92):
+        self.path = path
+        self.threshold = threshold
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS scoped_responses ("
+                "prompt_hash TEXT PRIMARY KEY, scope TEXT, embedding BLOB, "
+                "prompt TEXT, response TEXT, ts REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS scoped_responses_scope ON scoped_responses (scope)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # New connection per operation: safe across Streamlit session threads
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @staticmethod
+    def _hash(text: str, scope: str) -> str:
+        return hashlib.sha256(f"{scope}\n{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def get(self, text: str, scope: str) -> Optional[str]:
+        """Return the cached response for this exact text in scope, else None (no embedding needed)."""
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT response FROM scoped_responses WHERE prompt_hash = ?", (self._hash(text, scope),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def lookup(self, embedding: Sequence[float], scope: str) -> Optional[str]:
+        """Return the response of the most similar stored text in scope if above threshold, else None."""
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute("SELECT embedding, response FROM scoped_responses WHERE scope = ?", (scope,)).fetchall()
+        if not rows:
+            return None
+        query = self._normalize(embedding)
+        matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for blob, _ in rows])
+        if matrix.shape[1] != query.shape[0]:
+            return None
+        sims = matrix @ query
+        best = int(np.argmax(sims))
+        if sims[best] >= self.threshold:
+            return rows[best][1]
+        return None
+
+    def store(self, text: str, embedding: Sequence[float], scope: str, response: str) -> None:
+        blob = self._normalize(embedding).tobytes()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO scoped_responses (prompt_hash, scope, embedding, prompt, response, ts) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self._hash(text, scope), scope, blob, text, response, time.time()),
+            )
@@ -1,16 +1,38 @@
 # email_automation.py
 """
 Email automation backend (Gemini + SMTP).
-Provides generate_email(subject, template_key, context) and send_via_smtp(...)
+Provides generate_email(subject, template_key, context), stream_email(...),
+generate_emails_batch(...), generate_emails_multi(...)
+and send_via_smtp(...) / send_bulk_via_smtp(...)
 Safe to import into Streamlit (CLI run only when called as script).
 """
+import asyncio
+import atexit
+import copy
+import gzip
+import json
+import logging
 import os
+import re
 import smtplib
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from email.message import EmailMessage
-from typing import Dict
-from dotenv import load_dotenv
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
-load_dotenv()
+# Like the default load_dotenv() lookup, .env sits next to this module (not the cwd)
+_DOTENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+if os.path.exists(_DOTENV_PATH):
+    from dotenv import load_dotenv
+    load_dotenv(_DOTENV_PATH)
+
+logger = logging.getLogger(__name__)
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 SMTP_SERVER = os.getenv("SMTP_SERVER")
@@ -18,135 +40,715 @@ SMTP_PORT = int(os.getenv("SMTP_PORT") or 587)
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
 DEFAULT_SENDER_NAME = os.getenv("DEFAULT_SENDER_NAME") or "Aqib"
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT") or 60)
+# Socket timeout so a hung server can't block every sender waiting on _smtp_lock
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT") or 30)
+EMAIL_CACHE_SIZE = int(os.getenv("EMAIL_CACHE_SIZE") or 256)
+EMAIL_PROGRAM_CACHE = os.getenv("EMAIL_PROGRAM_CACHE", "1") == "1"
+# Shorter context values are too likely to match unrelated text to templatize
+PROGRAM_MIN_VALUE_LEN = 3
+# Generations above this temperature are meant to vary, so they are never cached
+CACHE_MAX_TEMPERATURE = 0.3
+# Output budget for models without a per-template budget (see _max_tokens)
+DEFAULT_MAX_TOKENS = 512
+SEM_CACHE_PATH = os.getenv("SEM_CACHE_PATH") or "gemini_cache.sqlite3"
+SEM_CACHE_THRESHOLD = float(os.getenv("SEM_CACHE_THRESHOLD") or 0.92)
+EMBED_MODEL = "text-embedding-004"
 
-if not GOOGLE_API_KEY:
-    raise RuntimeError("Set GOOGLE_API_KEY in your .env before running (Google GenAI key)")
-
-# Import google-genai SDK
-try:
-    from google import genai
-    from google.genai import types
-except Exception as e:
-    raise ImportError("google-genai SDK required. Run: pip install google-genai") from e
-
-# Create client
-client = genai.Client(api_key=GOOGLE_API_KEY)
-
-# Few-shot examples and templates
-FEW_SHOT_EXAMPLES = [
-    {
-        "subject": "Request for Meeting",
-        "message": "I hope you're doing well. I would like to schedule a meeting tomorrow to discuss the progress of our current project.\n\nRegards,\nAqib"
-    },
-    {
-        "subject": "Update on Task",
-        "message": "This is to inform you that I have completed the assigned task and shared the required documents.\n\nRegards,\nAqib"
-    }
-]
-
-TEMPLATES = {
-    "leave_request": {
-        "instruction": "Using the professional email format shown in the examples, write a short, 2-4 line email requesting one day of leave tomorrow. Keep it polite and concise.",
-        "placeholders": ["reason", "date"]
-    },
-    "meeting_request": {
-        "instruction": "Using the professional email format shown in the examples, write an email requesting to schedule a meeting to discuss project progress. Suggest two time slots.",
-        "placeholders": ["timeslots"]
-    },
-    "task_update": {
-        "instruction": "Using the professional email format shown in the examples, write a short update informing that the assigned task is complete and attachments were shared.",
-        "placeholders": []
+# The google-genai SDK (and numpy for the semantic cache) are imported on first
+# use, so importing this module stays cheap for Streamlit reloads and CLI --help.
+types = None  # google.genai.types, bound by _get_client()
+_client = None
+_client_lock = threading.Lock()
+_semantic_cache = None
+_semantic_cache_ready = False
+# Set after a non-transient embed failure (bad EMBED_MODEL, no permission) so later
+# calls stop paying a doomed round trip before every generation
+_embed_disabled = False
+
+def _new_client():
+    """Create a genai.Client (importing the SDK and binding types on first use)."""
+    global types
+    if not GOOGLE_API_KEY:
+        raise RuntimeError("Set GOOGLE_API_KEY in your .env before running (Google GenAI key)")
+    try:
+        from google import genai
+        from google.genai import types as _types
+    except Exception as e:
+        raise ImportError("google-genai SDK required. Run: pip install google-genai") from e
+    types = _types
+    return genai.Client(api_key=GOOGLE_API_KEY)
+
+def _get_client():
+    """Process-wide client for synchronous calls. Async callers use their own
+    client per event loop (see _async_client), since aio transports are loop-bound."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _new_client()
+    return _client
+
+@asynccontextmanager
+async def _async_client():
+    """A dedicated client for the running event loop, closed when the loop's work is done."""
+    client = _new_client()
+    try:
+        yield client
+    finally:
+        aclose = getattr(client.aio, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+def _get_semantic_cache():
+    """Semantic response cache, or None when it cannot be used (e.g. numpy not installed)."""
+    global _semantic_cache, _semantic_cache_ready
+    if not _semantic_cache_ready:
+        with _client_lock:
+            if not _semantic_cache_ready:
+                try:
+                    from cache import SemanticCache
+                    _semantic_cache = SemanticCache(SEM_CACHE_PATH, threshold=SEM_CACHE_THRESHOLD)
+                except Exception:
+                    # Cache problems (missing numpy, unwritable path) must never block generation
+                    logger.debug("Semantic cache disabled", exc_info=True)
+                    _semantic_cache = None
+                _semantic_cache_ready = True
+    return _semantic_cache
+
+# "Subject: ...\nMessage:\n..." model output, matched case-insensitively in one pass
+_RESP_RE = re.compile(r'^\s*Subject:[ \t]*(?P<subj>.*?)\n+Message:[ \t]*\n\s*(?P<msg>.*?)\s*$',
+                      re.IGNORECASE | re.DOTALL)
+
+# Few-shot examples and templates live in a gzipped JSON store. It is parsed once
+# per file mtime, so edits are picked up without a restart and hits cost one stat().
+# Each call takes one snapshot (_templates()) and passes it down, so a mid-call edit
+# cannot mix versions.
+TEMPLATES_PATH = os.getenv("EMAIL_TEMPLATES_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates.json.gz")
+
+# Prompt layout: everything invariant comes first so Gemini's implicit prefix
+# cache can reuse it; only the subject/context tail changes per request.
+_SYSTEM_PREAMBLE = "You are a helpful assistant that writes professional emails. Follow the exact format in the examples.\n\n"
+_FORMAT_INSTRUCTION = "Respond only with the email in the exact format: Subject: <...>\nMessage:\n<...>\nRegards,\nAqib"
+
+class _TemplateStore(NamedTuple):
+    few_shot_examples: List[Dict[str,str]]
+    templates: Dict[str, Dict]
+    few_shot_prefix: str
+    static: Dict[str,str]  # template_key -> static prompt prefix
+
+@lru_cache(maxsize=1)
+def _load_templates(mtime: float) -> _TemplateStore:
+    try:
+        import orjson
+        loads = orjson.loads
+    except ImportError:
+        loads = json.loads
+    with gzip.open(TEMPLATES_PATH, 'rb') as f:
+        raw = loads(f.read())
+    few_shot_prefix = _SYSTEM_PREAMBLE + "".join(
+        f"Subject: {ex['subject']}\nMessage:\n{ex['message']}\n\n" for ex in raw['FEW_SHOT_EXAMPLES']
+    )
+    static = {
+        key: f"{few_shot_prefix}Now write a new email.\nInstruction: {t['instruction']}\n\n{_FORMAT_INSTRUCTION}\n"
+        for key, t in raw['TEMPLATES'].items()
     }
-}
-
-def build_prompt(subject: str, template_key: str, context: Dict[str,str]={}) -> str:
-    prompt = "You are a helpful assistant that writes professional emails. Follow the exact format in the examples.\n\n"
-    for ex in FEW_SHOT_EXAMPLES:
-        prompt += f"Subject: {ex['subject']}\nMessage:\n{ex['message']}\n\n"
-    prompt += f"Now write a new email.\nSubject: {subject}\n"
-    template = TEMPLATES.get(template_key)
-    if not template:
+    return _TemplateStore(raw['FEW_SHOT_EXAMPLES'], raw['TEMPLATES'], few_shot_prefix, static)
+
+def _templates() -> _TemplateStore:
+    """Snapshot of the template store (one stat() per call)."""
+    return _load_templates(os.path.getmtime(TEMPLATES_PATH))
+
+def list_templates() -> List[str]:
+    return list(_templates().templates)
+
+def __getattr__(name: str):
+    # TEMPLATES / FEW_SHOT_EXAMPLES used to be module constants; keep them readable.
+    # Copies, because the prebuilt prompts would not see changes made to the live store:
+    # edit templates.json.gz instead.
+    if name == "TEMPLATES":
+        return copy.deepcopy(_templates().templates)
+    if name == "FEW_SHOT_EXAMPLES":
+        return copy.deepcopy(_templates().few_shot_examples)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def build_prompt(subject: str, template_key: str, context: Dict[str,str]={}, store: Optional[_TemplateStore]=None) -> str:
+    static = (store or _templates()).static.get(template_key)
+    if static is None:
         raise ValueError(f"Unknown template: {template_key}")
-    prompt += "Message:\n" + template['instruction']
+    parts = [static, "---\nSubject: ", subject, "\n"]
     if context:
-        prompt += "\nContext:"
-        for k,v in context.items():
-            prompt += f" {k}={v};"
-    prompt += "\n\nRespond only with the email in the exact format: Subject: <...>\nMessage:\n<...>\nRegards,\nAqib"
-    return prompt
-
-def _call_gemini_chat(prompt: str, model: str='gemini-2.5-flash', max_tokens: int=512, temperature: float=0.2) -> str:
-    """Call Google GenAI (Gemini) and return the assistant text."""
+        parts.append("Context: " + " ".join(f"{k}={v};" for k, v in context.items()) + "\n")
+    return "".join(parts)
+
+def _embed(text: str):
+    resp = _get_client().models.embed_content(model=EMBED_MODEL, contents=text)
+    return resp.embeddings[0].values
+
+def _is_transient(exc: BaseException) -> bool:
+    """Rate limits, server errors and errors without an HTTP code (network) may succeed on retry."""
+    code = getattr(exc, "code", None)
+    return not isinstance(code, int) or code == 429 or code >= 500
+
+def _semantic_key(subject: str, template_key: str, context: Dict[str,str], model: str, store: _TemplateStore) -> Tuple[str, str]:
+    """(scope, text) for the semantic cache. Prompts share ~95% of their text, so only
+    the subject is embedded; model, template, instruction and context values must match exactly."""
+    instruction = store.templates[template_key]['instruction']
+    scope = json.dumps([model, template_key, instruction, sorted(context.items())], ensure_ascii=False)
+    return scope, subject
+
+def _semantic_lookup(semantic_key: Optional[Tuple[str, str]], temperature: float, use_cache: bool):
+    """Return (cached_response, embedding). Either may be None; the embedding is kept
+    so a fresh response can be stored without embedding the text twice.
+    On a miss the embedding is one extra round trip before generation."""
+    global _embed_disabled
+    semantic_cache = _get_semantic_cache() if semantic_key and temperature <= CACHE_MAX_TEMPERATURE else None
+    if semantic_cache is None:
+        return None, None
+    scope, text = semantic_key
+    # Cache problems must never block generation
+    try:
+        cached = semantic_cache.get(text, scope) if use_cache else None
+    except Exception:
+        logger.warning("Semantic cache read failed", exc_info=True)
+        return None, None
+    if cached is not None or _embed_disabled:
+        return cached, None
+    try:
+        embedding = _embed(text)
+    except Exception as e:
+        if _is_transient(e):
+            logger.debug("Embedding failed; skipping semantic cache for this call", exc_info=True)
+        else:
+            _embed_disabled = True
+            logger.warning("Embedding with %s failed; semantic lookups disabled for this process", EMBED_MODEL, exc_info=True)
+        return None, None
+    try:
+        cached = semantic_cache.lookup(embedding, scope) if use_cache else None
+    except Exception:
+        logger.warning("Semantic cache lookup failed", exc_info=True)
+        cached = None
+    return cached, embedding
+
+def _semantic_store(semantic_key: Optional[Tuple[str, str]], embedding, response: str) -> None:
+    if semantic_key and embedding is not None and response:
+        scope, text = semantic_key
+        try:
+            _get_semantic_cache().store(text, embedding, scope, response)
+        except Exception:
+            logger.warning("Semantic cache store failed", exc_info=True)
+
+def _call_gemini_chat(prompt: str, model: str='gemini-2.5-flash', max_tokens: int=512, temperature: float=0.2, use_cache: bool=True, semantic_key: Optional[Tuple[str, str]]=None) -> str:
+    """Call Google GenAI (Gemini) and return the assistant text.
+    With a semantic_key (see _semantic_key) the semantic cache is consulted first;
+    use_cache=False skips the lookup but still stores the fresh response."""
+    cached, embedding = _semantic_lookup(semantic_key, temperature, use_cache)
+    if cached is not None:
+        return cached
+    text = _generate_text(prompt, model, max_tokens, temperature)
+    _semantic_store(semantic_key, embedding, text)
+    return text
+
+def _stream_gemini_chat(prompt: str, model: str='gemini-2.5-flash', max_tokens: int=512, temperature: float=0.2, use_cache: bool=True, semantic_key: Optional[Tuple[str, str]]=None) -> Iterator[str]:
+    """Like _call_gemini_chat, but yields text chunks as Gemini produces them.
+    A cache hit is yielded as a single chunk."""
+    cached, embedding = _semantic_lookup(semantic_key, temperature, use_cache)
+    if cached is not None:
+        yield cached
+        return
+    chunks = []
+    last = None
+    client = _get_client()
+    for chunk in client.models.generate_content_stream(
+        model=model,
+        contents=prompt,
+        config=_gen_config(model, temperature, max_tokens)
+    ):
+        last = chunk
+        text = chunk.text
+        if text:
+            chunks.append(text)
+            yield text
+    if not chunks:
+        # Same contract as _extract_text: an empty stream is an error, never a result
+        raise _empty_response_error(last)
+    _semantic_store(semantic_key, embedding, "".join(chunks))
+
+def _thinking_disabled(model: str) -> bool:
+    return model.startswith('gemini-2.5-flash')
+
+def _max_tokens(template: Dict, model: str) -> int:
+    """Output budget for one email. The tight per-template budgets assume thinking is
+    off; on other (thinking) models thinking tokens would use them up, so those keep
+    the generic DEFAULT_MAX_TOKENS, as does a template that sets none."""
+    if not _thinking_disabled(model):
+        return DEFAULT_MAX_TOKENS
+    return template.get('max_tokens', DEFAULT_MAX_TOKENS)
+
+def _gen_config(model: str, temperature: float=None, max_tokens: int=None, **kwargs):
+    """GenerateContentConfig for these short emails. Thinking is switched off on
+    Gemini 2.5 Flash: it adds hidden tokens (counted against max_output_tokens)
+    and latency that a 2-4 line email does not need."""
+    if _thinking_disabled(model):
+        kwargs['thinking_config'] = types.ThinkingConfig(thinking_budget=0)
+    return types.GenerateContentConfig(temperature=temperature, max_output_tokens=max_tokens, **kwargs)
+
+def _generate_text(prompt: str, model: str, max_tokens: int, temperature: float) -> str:
+    client = _get_client()
     # Use models.generate_content
     resp = client.models.generate_content(
         model=model,
         contents=prompt,
-        config=types.GenerateContentConfig(temperature=temperature, max_output_tokens=max_tokens)
+        config=_gen_config(model, temperature, max_tokens)
     )
-    # Try to extract textual output
-    text = getattr(resp, "text", None)
+    return _extract_text(resp)
+
+def _extract_text(resp) -> str:
+    text = resp.text
     if not text:
         try:
-            cand = resp.candidates[0]
-            text = getattr(cand, "text", None) or getattr(cand, "content", None) or str(cand)
-        except Exception:
-            text = str(resp)
-    return text or ""
-
-def generate_email(subject: str, template_key: str, context: Dict[str,str]={}, model: str='gemini-2.5-flash') -> Dict[str,str]:
-    prompt = build_prompt(subject, template_key, context)
-    content = _call_gemini_chat(prompt, model=model, max_tokens=300, temperature=0.2)
-    content = content.strip() if isinstance(content, str) else str(content).strip()
-    parsed = {"subject": subject, "message": content}
-    if content.lower().startswith('subject:'):
-        lower = content.lower()
-        idx = lower.find('\nmessage:\n')
-        if idx != -1:
-            subj_block = content[:idx]
-            msg_block = content[idx + len('\nmessage:\n'):]
-        else:
-            parts = content.split('\nMessage:\n', 1)
-            if len(parts) == 2:
-                subj_block, msg_block = parts
-            else:
-                subj_block = subject
-                msg_block = content
-        subj = subj_block.replace('Subject:', '').strip()
-        msg = msg_block.strip()
-        parsed['subject'] = subj
-        parsed['message'] = msg
-    return parsed
+            text = "".join(p.text for p in resp.candidates[0].content.parts if getattr(p, 'text', None))
+        except (AttributeError, IndexError, TypeError):
+            text = ""
+    if not text:
+        raise _empty_response_error(resp)
+    return text
 
-def send_via_smtp(to_email: str, subject: str, message_body: str, sender_display_name: str=DEFAULT_SENDER_NAME) -> None:
+def _empty_response_error(resp) -> RuntimeError:
+    # Report why instead of dumping the proto repr of the whole response
+    candidates = getattr(resp, 'candidates', None) or []
+    finish_reason = getattr(candidates[0], 'finish_reason', '?') if candidates else 'no candidates'
+    return RuntimeError(f"Empty Gemini response (finish_reason={finish_reason})")
+
+def parse_email_response(content: str, subject: str) -> Dict[str,str]:
+    m = _RESP_RE.match(content)
+    if m:
+        # The pattern already trims around the message; only the subject line may carry trailing spaces
+        return {"subject": m.group('subj').rstrip(), "message": m.group('msg')}
+    return {"subject": subject, "message": content.strip()}
+
+# Exact-match response cache for identical prompts (e.g. Streamlit reruns), shared by
+# generate_email and stream_email. Keyed by (prompt, model, max_tokens, temperature).
+_response_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _response_cache_get(key: tuple) -> Optional[str]:
+    with _response_cache_lock:
+        text = _response_cache.get(key)
+        if text is not None:
+            _response_cache.move_to_end(key)
+        return text
+
+def _response_cache_put(key: tuple, text: str) -> None:
+    if not text or not text.strip():
+        return
+    with _response_cache_lock:
+        _response_cache[key] = text
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > EMAIL_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+# Template programs: after a template has been generated once for a subject, later
+# requests with that subject and new values for the template's declared placeholders
+# are answered by substituting the values into the earlier output instead of calling
+# Gemini. Keyed by (template_key, model, instruction, subject) so edits to the template
+# store retire old programs; the free-text subject is never a substitution slot.
+_program_cache: Dict[tuple, Callable[[Dict[str,str]], Dict[str,str]]] = {}
+
+def _program_applies(template: Dict, context: Dict[str,str]) -> bool:
+    """Programs only cover templates with placeholders, called with exactly those keys."""
+    placeholders = template.get('placeholders') or []
+    return bool(placeholders) and sorted(context) == sorted(placeholders)
+
+def _synthesize_program(context: Dict[str,str], out: Dict[str,str]) -> Optional[Callable[[Dict[str,str]], Dict[str,str]]]:
+    """Turn one generated email into a fill-in program, or None if every context value
+    cannot be located as a whole word in the output (substitution points would be ambiguous)."""
+    keys = sorted(context)
+    # Context may carry numbers or dates; the program works on their text form
+    values = [str(context[k]) for k in keys]
+    if any(len(v) < PROGRAM_MIN_VALUE_LEN for v in values):
+        return None
+    def templatize(text: str) -> str:
+        text = text.replace("{", "{{").replace("}", "}}")
+        # Longest values first so a value that contains another is replaced whole
+        for idx in sorted(range(len(values)), key=lambda i: -len(values[i])):
+            escaped = values[idx].replace("{", "{{").replace("}", "}}")
+            # Whole words only: a value "day" must not turn "today" into "to{n}"
+            text = re.sub(r'(?<!\w)' + re.escape(escaped) + r'(?!\w)', lambda _: "{%d}" % idx, text)
+        return text
+    subj_tpl, msg_tpl = templatize(out['subject']), templatize(out['message'])
+    if any("{%d}" % idx not in subj_tpl + msg_tpl for idx in range(len(values))):
+        return None
+    def program(new_context: Dict[str,str]) -> Dict[str,str]:
+        args = [str(new_context[k]) for k in keys]
+        return {"subject": subj_tpl.format(*args), "message": msg_tpl.format(*args)}
+    return program
+
+@dataclass
+class _GenerationPlan:
+    """What generate_email / stream_email resolved before calling Gemini: either a
+    cached result, or the prompt and cache keys for a fresh generation."""
+    subject: str
+    result: Optional[Dict[str,str]] = None
+    prompt: str = ""
+    max_tokens: int = 0
+    semantic_key: Optional[Tuple[str, str]] = None
+    response_key: Optional[tuple] = None
+    program_key: Optional[tuple] = None
+    context: Dict[str,str] = field(default_factory=dict)
+    template: Dict = field(default_factory=dict)
+
+def _plan_generation(subject: str, template_key: str, context: Dict[str,str], model: str, temperature: float, use_cache: bool) -> _GenerationPlan:
+    # Freeze context order so equal dicts always build the same (cacheable) prompt
+    frozen_ctx = dict(sorted(context.items())) if context else {}
+    cacheable = use_cache and temperature <= CACHE_MAX_TEMPERATURE
+    store = _templates()
+    template = store.templates.get(template_key, {})
+    program_key = (template_key, model, template.get('instruction'), subject)
+    program = _program_cache.get(program_key) if cacheable and EMAIL_PROGRAM_CACHE and _program_applies(template, frozen_ctx) else None
+    if program:
+        return _GenerationPlan(subject, result=program(frozen_ctx))
+    prompt = build_prompt(subject, template_key, frozen_ctx, store)
+    max_tokens = _max_tokens(template, model)
+    plan = _GenerationPlan(
+        subject, prompt=prompt, max_tokens=max_tokens,
+        semantic_key=_semantic_key(subject, template_key, frozen_ctx, model, store),
+        response_key=(prompt, model, max_tokens, temperature) if temperature <= CACHE_MAX_TEMPERATURE else None,
+        program_key=program_key, context=frozen_ctx, template=template,
+    )
+    if cacheable:
+        text = _response_cache_get(plan.response_key)
+        if text is not None:
+            plan.result = parse_email_response(text, subject)
+    return plan
+
+def _finish_generation(plan: _GenerationPlan, content: str) -> Dict[str,str]:
+    """Record a fresh generation in the exact-match and program caches and parse it."""
+    out = parse_email_response(content, plan.subject)
+    if plan.response_key is not None:
+        _response_cache_put(plan.response_key, content)
+        if EMAIL_PROGRAM_CACHE and _program_applies(plan.template, plan.context):
+            # A forced regeneration replaces the stored program
+            program = _synthesize_program(plan.context, out)
+            with _response_cache_lock:
+                _program_cache.pop(plan.program_key, None)
+                if program:
+                    _program_cache[plan.program_key] = program
+                    while len(_program_cache) > EMAIL_CACHE_SIZE:
+                        _program_cache.pop(next(iter(_program_cache)), None)
+    return out
+
+def generate_email(subject: str, template_key: str, context: Dict[str,str]={}, model: str='gemini-2.5-flash', temperature: float=0.2, use_cache: bool=True) -> Dict[str,str]:
+    plan = _plan_generation(subject, template_key, context, model, temperature, use_cache)
+    if plan.result is not None:
+        return plan.result
+    content = _call_gemini_chat(plan.prompt, model=model, max_tokens=plan.max_tokens, temperature=temperature,
+                                use_cache=use_cache, semantic_key=plan.semantic_key)
+    return _finish_generation(plan, content)
+
+def _clear_generate_caches() -> None:
+    with _response_cache_lock:
+        _response_cache.clear()
+        _program_cache.clear()
+
+generate_email.cache_clear = _clear_generate_caches
+
+def stream_email(subject: str, template_key: str, context: Dict[str,str]={}, model: str='gemini-2.5-flash', temperature: float=0.2, use_cache: bool=True) -> Iterator[str]:
+    """Yield the raw email text in chunks as it is generated; join and pass to
+    parse_email_response() to get the subject/message dict. Uses the same caches as
+    generate_email; a cache hit is yielded as a single chunk."""
+    plan = _plan_generation(subject, template_key, context, model, temperature, use_cache)
+    if plan.result is not None:
+        yield f"Subject: {plan.result['subject']}\nMessage:\n{plan.result['message']}"
+        return
+    chunks = []
+    for chunk in _stream_gemini_chat(plan.prompt, model=model, max_tokens=plan.max_tokens, temperature=temperature,
+                                     use_cache=use_cache, semantic_key=plan.semantic_key):
+        chunks.append(chunk)
+        yield chunk
+    _finish_generation(plan, "".join(chunks))
+
+@lru_cache(maxsize=1)
+def _email_out_schema():
+    from pydantic import BaseModel
+
+    class EmailOut(BaseModel):
+        subject: str
+        message: str
+
+    return list[EmailOut]
+
+MULTI_CHUNK_SIZE = 20
+
+def _generate_multi_chunk(requests: List[Dict], model: str, store: _TemplateStore) -> List[Dict[str,str]]:
+    templates = store.templates
+    items = [
+        {"subject": r['subject'], "instruction": templates[r['template_key']]['instruction'], "context": r.get('context') or {}}
+        for r in requests
+    ]
+    prompt = (store.few_shot_prefix
+              + "Write one new email per request below, following each request's instruction and context. "
+              "Produce a JSON array, one object per request in the same order, with fields subject and message. "
+              "Each message must end with:\nRegards,\nAqib\nRequests:\n"
+              + json.dumps(items, ensure_ascii=False))
+    client = _get_client()
+    resp = client.models.generate_content(
+        model=model,
+        contents=prompt,
+        config=_gen_config(
+            model,
+            temperature=0.2,
+            # JSON punctuation adds some overhead on top of each email's own budget
+            max_tokens=sum(_max_tokens(templates[r['template_key']], model) + 40 for r in requests),
+            response_mime_type='application/json',
+            response_schema=_email_out_schema(),
+        )
+    )
+    out = json.loads(_extract_text(resp))
+    if not isinstance(out, list) or len(out) != len(requests):
+        raise ValueError(f"Expected {len(requests)} emails, got {len(out) if isinstance(out, list) else type(out).__name__}")
+    return [{"subject": e.get('subject') or r['subject'], "message": (e.get('message') or "").strip()} for e, r in zip(out, requests)]
+
+def generate_emails_multi(requests: List[Dict], model: str='gemini-2.5-flash') -> List[Dict[str,str]]:
+    """Generate many emails with one Gemini call per chunk of MULTI_CHUNK_SIZE requests,
+    using structured JSON output. Each request is a dict with subject, template_key and
+    optional context. A chunk whose response cannot be parsed falls back to one
+    generate_email call per request."""
+    store = _templates()
+    for r in requests:
+        if r['template_key'] not in store.templates:
+            raise ValueError(f"Unknown template: {r['template_key']}")
+    results = []
+    for i in range(0, len(requests), MULTI_CHUNK_SIZE):
+        chunk = requests[i:i + MULTI_CHUNK_SIZE]
+        try:
+            results.extend(_generate_multi_chunk(chunk, model, store))
+        except (ValueError, AttributeError, TypeError, RuntimeError):
+            logger.warning("Multi-email response unusable; falling back to per-request calls", exc_info=True)
+            results.extend(generate_email(r['subject'], r['template_key'], r.get('context') or {}, model=model) for r in chunk)
+    return results
+
+def _is_rate_limited(exc: BaseException) -> bool:
+    return getattr(exc, "code", None) == 429
+
+@retry(retry=retry_if_exception(_is_rate_limited), wait=wait_random_exponential(1, 30), stop=stop_after_attempt(5), reraise=True)
+async def _async_generate(client, subject: str, template_key: str, context: Dict[str,str]={}, model: str='gemini-2.5-flash', temperature: float=0.2) -> Dict[str,str]:
+    """Async counterpart of generate_email (uses client.aio), retried with jittered backoff on 429.
+    client must belong to the running event loop (see _async_client)."""
+    store = _templates()
+    prompt = build_prompt(subject, template_key, dict(sorted(context.items())) if context else {}, store)
+    resp = await client.aio.models.generate_content(
+        model=model,
+        contents=prompt,
+        config=_gen_config(model, temperature, _max_tokens(store.templates[template_key], model))
+    )
+    return parse_email_response(_extract_text(resp), subject)
+
+async def generate_emails_batch(requests: List[Dict], max_concurrency: int=4) -> List:
+    """Generate many emails concurrently. Each request is a dict with subject, template_key
+    and optional context. Returns results in request order; failed items are exceptions.
+    Requests still rate-limited after retries are re-run with half the concurrency.
+    Safe to call once per asyncio.run(): each call uses its own client."""
+    async with _async_client() as client:
+        return await _run_batch(client, requests, max_concurrency)
+
+async def _run_batch(client, requests: List[Dict], max_concurrency: int) -> List:
+    sem = asyncio.Semaphore(max_concurrency)
+    async def one(r):
+        async with sem:
+            return await _async_generate(client, r['subject'], r['template_key'], r.get('context') or {})
+    results = await asyncio.gather(*(one(r) for r in requests), return_exceptions=True)
+    limited = [i for i, res in enumerate(results) if isinstance(res, Exception) and _is_rate_limited(res)]
+    if limited and max_concurrency > 1:
+        retried = await _run_batch(client, [requests[i] for i in limited], max(1, max_concurrency // 2))
+        for i, res in zip(limited, retried):
+            results[i] = res
+    return results
+
+# Authenticated SMTP sessions reused across sends, keyed by (server, port).
+# Each entry is (connection, last_used); the lock makes a connection single-user.
+_smtp_pool: Dict[tuple, tuple] = {}
+_smtp_lock = threading.RLock()
+
+def _open_smtp() -> smtplib.SMTP:
+    smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    try:
+        smtp.starttls()
+        smtp.login(SMTP_USER, SMTP_PASS)
+    except Exception:
+        # Don't leak the connected socket on TLS or auth failures
+        smtp.close()
+        raise
+    return smtp
+
+def _discard_smtp(smtp: smtplib.SMTP) -> None:
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
+def _get_smtp(probe: bool=True) -> smtplib.SMTP:
+    """Return a live pooled SMTP session, reconnecting if it is stale or dead. Call with _smtp_lock held.
+    probe=False skips the NOOP check (for back-to-back sends on a just-verified session)."""
+    key = (SMTP_SERVER, SMTP_PORT)
+    entry = _smtp_pool.pop(key, None)
+    if entry:
+        smtp, last_used = entry
+        if time.monotonic() - last_used < SMTP_IDLE_TIMEOUT:
+            try:
+                if not probe or smtp.noop()[0] == 250:
+                    _smtp_pool[key] = (smtp, time.monotonic())
+                    return smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+        # Stale or dead: drop the socket rather than block on a QUIT under the lock
+        smtp.close()
+    smtp = _open_smtp()
+    _smtp_pool[key] = (smtp, time.monotonic())
+    return smtp
+
+def close_smtp_pool() -> None:
+    with _smtp_lock:
+        while _smtp_pool:
+            smtp, _ = _smtp_pool.popitem()[1]
+            _discard_smtp(smtp)
+
+atexit.register(close_smtp_pool)
+
+def _check_smtp_settings() -> None:
     if not SMTP_SERVER or not SMTP_USER or not SMTP_PASS:
         raise RuntimeError("SMTP settings missing in .env (SMTP_SERVER/SMTP_USER/SMTP_PASS).")
+
+def _build_message(to_header: str, subject: str, message_body: str, sender_display_name: str) -> EmailMessage:
     msg = EmailMessage()
     msg['From'] = f"{sender_display_name} <{SMTP_USER}>"
-    msg['To'] = to_email
+    msg['To'] = to_header
     msg['Subject'] = subject
     msg.set_content(message_body)
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-        smtp.starttls()
-        smtp.login(SMTP_USER, SMTP_PASS)
-        smtp.send_message(msg)
+    return msg
+
+def _send_pooled(msg: EmailMessage, to_addrs: List[str]=None, probe: bool=True) -> Dict:
+    """Send one message over the pooled session; returns smtplib's refused-recipients dict."""
+    with _smtp_lock:
+        smtp = _get_smtp(probe)
+        try:
+            return smtp.send_message(msg, from_addr=SMTP_USER, to_addrs=to_addrs)
+        except smtplib.SMTPServerDisconnected:
+            # Server dropped the session between the NOOP probe and send: retry once on a fresh one
+            _smtp_pool.pop((SMTP_SERVER, SMTP_PORT), None)
+            smtp = _get_smtp()
+            return smtp.send_message(msg, from_addr=SMTP_USER, to_addrs=to_addrs)
+
+def send_via_smtp(to_email: str, subject: str, message_body: str, sender_display_name: str=DEFAULT_SENDER_NAME) -> None:
+    _check_smtp_settings()
+    _send_pooled(_build_message(to_email, subject, message_body, sender_display_name))
+
+def send_bulk_via_smtp(to_emails: List[str], subject: str, message_body: str, sender_display_name: str=DEFAULT_SENDER_NAME) -> Dict:
+    """Deliver the same email to many recipients in one SMTP transaction
+    (one MAIL FROM, one RCPT TO per recipient, one DATA). Recipients are not
+    disclosed to each other. Returns the refused recipients, if any."""
+    _check_smtp_settings()
+    if not to_emails:
+        return {}
+    msg = _build_message("undisclosed-recipients:;", subject, message_body, sender_display_name)
+    start = time.monotonic()
+    refused = _send_pooled(msg, to_addrs=list(to_emails))
+    _log_throughput(len(to_emails) - len(refused), time.monotonic() - start)
+    return refused
+
+def send_many_via_smtp(messages: List[Tuple[str, str, str]], sender_display_name: str=DEFAULT_SENDER_NAME) -> List:
+    """Send different (to_email, subject, body) emails back to back over the pooled
+    session, so the connection/TLS/login cost is paid once. Returns one entry per
+    message: None on success, or the exception raised for that message."""
+    _check_smtp_settings()
+    results = []
+    start = time.monotonic()
+    with _smtp_lock:
+        smtp = _get_smtp()
+        if not smtp.has_extn('pipelining'):
+            logger.debug("SMTP server does not advertise PIPELINING; sending sequentially")
+        for to_email, subject, body in messages:
+            try:
+                # Session was probed above; a dropped session is still retried once
+                _send_pooled(_build_message(to_email, subject, body, sender_display_name), probe=False)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+    _log_throughput(results.count(None), time.monotonic() - start)
+    return results
+
+def _log_throughput(delivered: int, elapsed: float) -> None:
+    rate = delivered / elapsed if elapsed > 0 else float(delivered)
+    logger.info("Delivered %d emails in %.2fs (%.1f/s)", delivered, elapsed, rate)
+
+def _warmup() -> None:
+    """Resolve DNS and open the HTTPS connection to Gemini ahead of the first real request."""
+    try:
+        socket.getaddrinfo("generativelanguage.googleapis.com", 443)
+        _get_client().models.generate_content(
+            model='gemini-2.5-flash',
+            contents='ping',
+            config=_gen_config('gemini-2.5-flash', max_tokens=1)
+        )
+    except Exception:
+        logger.debug("Gemini warmup failed", exc_info=True)
+
+def start_warmup() -> bool:
+    """Warm up the Gemini connection in a background thread. Meant for long-lived
+    frontends (the Streamlit app) before the first user request; one-shot CLI runs
+    gain nothing from it. Skipped when EMAIL_WARMUP=0 or GOOGLE_API_KEY is unset.
+    Returns True if a warmup was started."""
+    if os.getenv("EMAIL_WARMUP", "1") != "1" or not GOOGLE_API_KEY:
+        return False
+    threading.Thread(target=_warmup, daemon=True).start()
+    return True
+
+async def _run_jobs(jobs: List[Dict], send: bool=False) -> List:
+    """Generate (and optionally send) many jobs in one process. Each job is a dict with
+    to, subject, template and optional context. Sends reuse the pooled SMTP session."""
+    sem = asyncio.Semaphore(int(os.getenv('GEN_CONCURRENCY') or 4))
+    async with _async_client() as client:
+        async def run(j):
+            async with sem:
+                out = await _async_generate(client, j['subject'], j.get('template', 'leave_request'), j.get('context') or {})
+            if send:
+                await asyncio.to_thread(send_via_smtp, j['to'], out['subject'], out['message'])
+            return out
+        return await asyncio.gather(*(run(j) for j in jobs), return_exceptions=True)
 
 # Allow CLI use safely
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Generate and optionally send professional emails via Gemini")
-    parser.add_argument('--to', required=True, help='Recipient email address')
-    parser.add_argument('--subject', required=True, help='Email subject')
+    parser.add_argument('--to', help='Recipient email address')
+    parser.add_argument('--subject', help='Email subject')
     parser.add_argument('--template', default='leave_request', help='Template key')
     parser.add_argument('--send', action='store_true', help='If provided, actually send via SMTP')
     parser.add_argument('--context', nargs='*', help='Optional context vars key=value')
+    parser.add_argument('--force', action='store_true', help='Ignore cached drafts and call Gemini')
+    parser.add_argument('--jobs', help='JSONL file, one job per line: {"to", "subject", "template", "context"}')
     args = parser.parse_args()
+    if args.jobs:
+        with open(args.jobs, encoding='utf-8') as f:
+            jobs = [json.loads(line) for line in f if line.strip()]
+        results = asyncio.run(_run_jobs(jobs, send=args.send))
+        failed = 0
+        for job, res in zip(jobs, results):
+            if isinstance(res, Exception):
+                failed += 1
+                print(f"FAILED {job.get('to')}: {res}")
+            else:
+                print(f"{'Sent' if args.send else 'Generated'} {job.get('to')}: {res['subject']}")
+        raise SystemExit(1 if failed else 0)
+    if not args.to or not args.subject:
+        parser.error("--to and --subject are required unless --jobs is given")
     context = {}
     if args.context:
         for kv in args.context:
             if '=' in kv:
                 k,v = kv.split('=',1)
                 context[k]=v
-    out = generate_email(args.subject, args.template, context)
+    out = generate_email(args.subject, args.template, context, use_cache=not args.force)
     print("Subject:", out['subject'])
     print("Message:\n", out['message'])
     if args.send:
@@ -0,0 +1,59 @@
+# jobs.py
+"""
+Background job queue for SMTP sends, so the Streamlit UI does not block on SMTP.
+submit_send(...) returns a SendJob immediately; poll job.status / job.error.
+"""
+import os
+import smtplib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from email_automation import send_via_smtp
+
+SMTP_MAX_PARALLEL = int(os.getenv("SMTP_MAX_PARALLEL") or 3)
+
+# Sends share the pooled SMTP session in email_automation, so workers mostly
+# serialise on it; the pool size bounds how many jobs can be queued in flight.
+_executor = ThreadPoolExecutor(max_workers=SMTP_MAX_PARALLEL, thread_name_prefix="smtp-send")
+
+
+def _is_transient(exc: BaseException) -> bool:
+    # 4xx replies (e.g. 421 rate limiting, 451 local error) and dropped connections are worth retrying
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    return False
+
+
+@retry(retry=retry_if_exception(_is_transient), wait=wait_random_exponential(1, 30), stop=stop_after_attempt(4), reraise=True)
+def _send_with_retry(to_email: str, subject: str, message_body: str) -> None:
+    send_via_smtp(to_email, subject, message_body)
+
+
+@dataclass
+class SendJob:
+    to_email: str
+    subject: str
+    future: Future = field(repr=False)
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return "running" if self.future.running() else "queued"
+        return "failed" if self.future.exception() else "sent"
+
+    @property
+    def error(self) -> Optional[str]:
+        if self.future.done() and self.future.exception():
+            return str(self.future.exception())
+        return None
+
+
+def submit_send(to_email: str, subject: str, message_body: str) -> SendJob:
+    """Queue an email for sending in the background (transient SMTP errors are retried with jitter)."""
+    fut = _executor.submit(_send_with_retry, to_email, subject, message_body)
+    return SendJob(to_email, subject, fut)
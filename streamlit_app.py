@@ -1,4 +1,6 @@
 # streamlit_app.py
+import asyncio
+import collections
 import streamlit as st
 import traceback
 from pathlib import Path
@@ -13,22 +15,33 @@ st.title("Email Automation — Gemini (Google GenAI)")
 
 # import backend functions
 try:
-    from email_automation import generate_email, send_via_smtp
+    from email_automation import generate_email, generate_emails_batch, list_templates, parse_email_response, start_warmup, stream_email
+    from jobs import submit_send
 except Exception as e:
     st.error("Could not import email_automation.py. Ensure the file is in the same folder and google-genai is installed.")
     st.exception(e)
     st.stop()
 
+@st.cache_resource(show_spinner=False)
+def _warm_gemini():
+    # Once per server process, not on every rerun or session
+    return start_warmup()
+
+_warm_gemini()
+
 st.markdown("Use the template dropdown to generate professional emails. Requires GOOGLE_API_KEY in `.env`.")
 
 # Inputs
 to_email = st.text_input("To (recipient email)")
 subject = st.text_input("Subject", value="Request for One Day Leave")
-template = st.selectbox("Template", options=["leave_request", "meeting_request", "task_update"])
+template = st.selectbox("Template", options=list_templates())
 st.text("Context variables (one per line, key=value). Example: reason=personal")
 context_raw = st.text_area("Context (optional)", height=100)
 send_immediately = st.checkbox("Send email after generation (uses SMTP in .env)", value=False)
+force_regenerate = st.checkbox("Force regenerate (ignore cached drafts)", value=False)
+stream_output = st.checkbox("Stream output while generating", value=True)
 
+@st.cache_data(show_spinner=False)
 def parse_context(text: str):
     ctx={}
     for line in text.splitlines():
@@ -40,22 +53,64 @@ def parse_context(text: str):
     return ctx
 
 ctx = parse_context(context_raw)
+send_jobs = st.session_state.setdefault("send_jobs", [])
+
+@st.cache_data(show_spinner="Generating email...", ttl=3600, max_entries=128)
+def _cached_generate(subject: str, template: str, ctx_items: tuple):
+    # ctx_items is a sorted tuple of (key, value) pairs so Streamlit can hash it
+    return generate_email(subject, template, dict(ctx_items))
+
+# Recent drafts for this session, so returning to earlier inputs (e.g. switching the
+# template back) shows the draft again without another generation
+GEN_CACHE_SIZE = 32
+gen_cache = st.session_state.setdefault("gen_cache", collections.OrderedDict())
+gen_key = (subject, template, tuple(sorted(ctx.items())))
+
+def show_draft(out: dict):
+    st.markdown("**Subject:**")
+    st.code(out.get("subject", subject))
+    st.markdown("**Message:**")
+    st.text_area("Generated message", value=out.get("message",""), height=200, key="generated_msg")
+    st.session_state["last_generated"] = out
 
 col1, col2 = st.columns(2)
 with col1:
     if st.button("Generate Email"):
         try:
-            with st.spinner("Generating email..."):
-                out = generate_email(subject, template, ctx)
+            if gen_key in gen_cache and not force_regenerate:
+                out = gen_cache[gen_key]
+                gen_cache.move_to_end(gen_key)
+            else:
+                if stream_output:
+                    # Show text as it arrives, then replace it with the parsed result
+                    placeholder = st.empty()
+                    with placeholder.container():
+                        raw = st.write_stream(stream_email(subject, template, ctx, use_cache=not force_regenerate))
+                    placeholder.empty()
+                    out = parse_email_response(raw if isinstance(raw, str) else "".join(map(str, raw)), subject)
+                elif force_regenerate:
+                    # Bypass only this key; other users' cached drafts stay warm
+                    with st.spinner("Generating email..."):
+                        out = generate_email(subject, template, ctx, use_cache=False)
+                else:
+                    out = _cached_generate(subject, template, tuple(sorted(ctx.items())))
+                gen_cache[gen_key] = out
+                if len(gen_cache) > GEN_CACHE_SIZE:
+                    gen_cache.popitem(last=False)
             st.success("Generated")
-            st.markdown("**Subject:**")
-            st.code(out.get("subject", subject))
-            st.markdown("**Message:**")
-            st.text_area("Generated message", value=out.get("message",""), height=200, key="generated_msg")
-            st.session_state["last_generated"] = out
+            show_draft(out)
+            if send_immediately:
+                if to_email:
+                    send_jobs.append(submit_send(to_email, out.get("subject", subject), out.get("message", "")))
+                    st.info(f"Queued email to {to_email}")
+                else:
+                    st.warning("Not sent: enter a recipient email in the 'To' field.")
         except Exception as e:
             st.error("Generation failed. See details below.")
             st.code(traceback.format_exc())
+    elif gen_key in gen_cache:
+        gen_cache.move_to_end(gen_key)
+        show_draft(gen_cache[gen_key])
 
 with col2:
     if st.button("Send Email (from last generated)"):
@@ -68,13 +123,44 @@ with col2:
             if not to_email:
                 st.error("Please enter recipient email in the 'To' field.")
             else:
-                try:
-                    with st.spinner("Sending via SMTP..."):
-                        send_via_smtp(to_email, subj, msg)
-                    st.success(f"Email sent to {to_email}")
-                except Exception as e:
-                    st.error("Failed to send email. Make sure SMTP env vars are set.")
-                    st.code(traceback.format_exc())
+                # Sent in the background; progress is shown in the table below
+                send_jobs.append(submit_send(to_email, subj, msg))
+                st.info(f"Queued email to {to_email}")
+
+if send_jobs:
+    st.markdown("**Send status**")
+    st.button("Refresh status")
+    st.table([{"to": j.to_email, "subject": j.subject, "status": j.status, "error": j.error or ""} for j in send_jobs])
+    if any(j.status == "failed" for j in send_jobs):
+        st.caption("Failed sends: make sure SMTP env vars are set in .env.")
+
+st.markdown("---")
+with st.expander("Batch generate (one email per row)"):
+    st.text("Context per row uses key=value pairs separated by ';'. Example: reason=personal;date=Monday")
+    batch_rows = st.data_editor(
+        [{"subject": subject, "template": template, "context": ""}],
+        num_rows="dynamic",
+        column_config={
+            "template": st.column_config.SelectboxColumn(options=list_templates(), required=True),
+        },
+        key="batch_rows",
+    )
+    if st.button("Generate Batch"):
+        reqs = [
+            {"subject": row["subject"], "template_key": row["template"], "context": parse_context((row.get("context") or "").replace(";", "\n"))}
+            for row in batch_rows if row.get("subject") and row.get("template")
+        ]
+        if not reqs:
+            st.warning("Add at least one row with a subject and template.")
+        else:
+            with st.spinner(f"Generating {len(reqs)} emails..."):
+                results = asyncio.run(generate_emails_batch(reqs))
+            for req, res in zip(reqs, results):
+                if isinstance(res, Exception):
+                    st.error(f"{req['subject']}: generation failed ({res})")
+                else:
+                    st.markdown(f"**{res.get('subject', req['subject'])}**")
+                    st.text(res.get("message", ""))
 
 st.markdown("---")
 st.info("Notes: make sure GOOGLE_API_KEY is set in .env and google-genai is installed.")